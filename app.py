@@ -1,6 +1,7 @@
 import os
 
 from llama_index.core import (
+    QueryBundle,
     Settings,
     SimpleDirectoryReader,
     StorageContext,
@@ -8,60 +9,78 @@ from llama_index.core import (
     load_index_from_storage,
 )
 from llama_index.embeddings.huggingface import HuggingFaceEmbedding
-from llama_index.llms.ollama import Ollama
-from dotenv import load_dotenv
+import torch
 
-load_dotenv()
+# Importing rag loads .env, so the settings below see it
+from rag import build_llm
+from rag_cache import LRUSimCache, SQLiteResponseCache, embed_query
 
 # ================== MULTILINGUAL CONFIG (CRUCIAL FOR SPANISH) ==================
-Settings.embed_model = HuggingFaceEmbedding(model_name="BAAI/bge-m3")  # Best for Spanish + English
+EMBED_DEVICE = os.getenv("EMBED_DEVICE") or ("cuda" if torch.cuda.is_available() else "cpu")
+EMBED_FP16 = os.getenv("EMBED_FP16", "1") == "1"
+EMBED_INT8 = os.getenv("EMBED_INT8", "0") == "1"
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "128" if EMBED_DEVICE.startswith("cuda") else "32"))
 
-# LLM choice (set LLM_PROVIDER=grok or LLM_PROVIDER=ollama)
-llm_provider = os.getenv("LLM_PROVIDER", "ollama").lower()
 
-if llm_provider == "grok":
-    # Grok API via OpenAI-compatible endpoint
-    # Expected env vars:
-    #   XAI_API_KEY or OPENAI_API_KEY (required)
-    #   GROK_MODEL (optional, default grok-4-0709)
-    #   GROK_CONTEXT_WINDOW (optional, default 128000)
-    from llama_index.llms.openai_like import OpenAILike
+def build_embed_model() -> HuggingFaceEmbedding:
+    embed_model = HuggingFaceEmbedding(
+        model_name="BAAI/bge-m3",  # Best for Spanish + English
+        embed_batch_size=EMBED_BATCH_SIZE,
+        device=EMBED_DEVICE,
+    )
+    # BAAI recommends fp16 for bge-m3; llama-index doesn't expose it, so cast the
+    # underlying SentenceTransformer once. Half precision only pays off on GPU,
+    # on CPU the model stays in fp32.
+    if EMBED_FP16 and EMBED_DEVICE.startswith("cuda"):
+        embed_model._model.half()
+    # CPU deployments: dynamic INT8 quantization of the Linear layers (VNNI dot
+    # products instead of fp32 GEMM, roughly half the resident size).
+    elif EMBED_INT8 and EMBED_DEVICE == "cpu":
+        torch.ao.quantization.quantize_dynamic(
+            embed_model._model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+    return embed_model
 
-    grok_api_key = os.getenv("XAI_API_KEY") or os.getenv("OPENAI_API_KEY")
-    if not grok_api_key:
-        raise RuntimeError("Missing XAI_API_KEY for Grok. Set XAI_API_KEY in your environment.")
 
-    grok_model = os.getenv("GROK_MODEL", "grok-4-0709")
-    grok_context_window = int(os.getenv("GROK_CONTEXT_WINDOW", "128000"))
+Settings.embed_model = build_embed_model()
+# Fixed chunk size keeps embedding batch shapes uniform.
+Settings.chunk_size = 512
 
-    Settings.llm = OpenAILike(
-        model=grok_model,
-        api_base="https://api.x.ai/v1",
-        api_key=grok_api_key,
-        context_window=grok_context_window,
-        is_chat_model=True,
-        is_function_calling_model=False,
-        timeout=180.0,
-    )
-else:
-    Settings.llm = Ollama(model="llama3.2", request_timeout=180.0)  # Works great in Spanish
+# Same LLM setup (LLM_PROVIDER=grok|ollama) as the bot, see rag.build_llm
+Settings.llm = build_llm()
 
 # ================== BUILD / LOAD ==================
 PERSIST_DIR = "./storage"
+# Answers survive restarts; kept apart from the bot's cache (different embeddings/index)
+exact_cache = SQLiteResponseCache(os.getenv("APP_CACHE_DB", "./qcache.sqlite3"))
 if not os.path.exists(PERSIST_DIR):
     print("Construyendo índice...")
-    documents = SimpleDirectoryReader("driving_data").load_data()
-    index = VectorStoreIndex.from_documents(documents)
+    exact_cache.clear()
+    # Parse everything into nodes first so embedding runs as one batched pass.
+    nodes = []
+    for documents in SimpleDirectoryReader("driving_data").iter_data():
+        nodes.extend(Settings.node_parser.get_nodes_from_documents(documents))
+    index = VectorStoreIndex(nodes, show_progress=True)
     index.storage_context.persist(persist_dir=PERSIST_DIR)
 else:
     storage_context = StorageContext.from_defaults(persist_dir=PERSIST_DIR)
     index = load_index_from_storage(storage_context)
 
 query_engine = index.as_query_engine(similarity_top_k=6)
+# Built after the index is loaded, so a rebuild always starts with an empty cache.
+response_cache = LRUSimCache()
 
 # Simple chat
 while True:
     q = input("\nPregunta sobre el examen teórico (o 'salir'): ")
     if q.lower() in ["salir", "quit", "exit"]: break
-    response = query_engine.query(q)
+    response = exact_cache.get(q)
+    if response is None:
+        # One embedding for both the semantic cache and retrieval
+        embedding = embed_query(q)
+        response = response_cache.get(q, embedding=embedding)
+        if response is None:
+            response = str(query_engine.query(QueryBundle(q, embedding=embedding)))
+            response_cache.put(q, (), response, embedding=embedding)
+            exact_cache.put(q, (), response)
     print("\nRespuesta:", response)
@@ -6,14 +6,14 @@ from dotenv import load_dotenv
 import asyncio
 import logging
 import time
+from functools import lru_cache
 from telegram import Update
 from telegram.error import RetryAfter
 from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes, MessageHandler, filters
 
-from parsing import parse_screenshot
-from rag import get_query_engine
-
-query_engine = None
+from parsing import parse_screenshot_bytes_async
+from rag import aanswer_query, warmup
+from rag_cache import SQLiteResponseCache
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("telegram-rag-bot")
@@ -30,7 +30,28 @@ WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip()
 WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook").strip() or "/webhook"
 PORT = int(os.getenv("PORT", "8080"))
 SCREENSHOTS_DIR = os.getenv("SCREENSHOTS_DIR", "./screenshots")
-os.makedirs(SCREENSHOTS_DIR, exist_ok=True)
+SAVE_SCREENSHOTS = os.getenv("SAVE_SCREENSHOTS", "0") == "1"
+if SAVE_SCREENSHOTS:
+    os.makedirs(SCREENSHOTS_DIR, exist_ok=True)
+
+RAG_CACHE_DB = os.getenv("RAG_CACHE_DB", "./rag_cache.sqlite3")
+RAG_CACHE_DAYS = int(os.getenv("RAG_CACHE_DAYS", "30"))
+
+exact_cache = SQLiteResponseCache(RAG_CACHE_DB, ttl_days=RAG_CACHE_DAYS)
+
+# ================== VISION API CONCURRENCY ==================
+# At most PARSE_MAX_CONCURRENCY vision calls in flight (xAI rate limits). Chat
+# completions take one screenshot per request, so there is nothing to batch:
+# each screenshot is dispatched as soon as a slot is free.
+PARSE_MAX_CONCURRENCY = int(os.getenv("PARSE_MAX_CONCURRENCY", "8"))
+
+parse_semaphore = asyncio.Semaphore(PARSE_MAX_CONCURRENCY)
+background_tasks: set = set()
+
+
+async def parse_screenshot_limited(img_bytes: bytes, filename: str) -> dict:
+    async with parse_semaphore:
+        return await parse_screenshot_bytes_async(img_bytes, filename)
 
 
 def format_result(data: dict) -> str:
@@ -69,6 +90,22 @@ def format_result(data: dict) -> str:
     return "\n".join(lines)
 
 
+@lru_cache(maxsize=1024)
+def build_query(question: str, options: tuple) -> str:
+    # Screenshots of the same question (e.g. a batch of users on one test) reuse the prompt
+    prompt_lines = [
+        "Analyze the driver's theory test question (Spanish Permiso B / DGT).",
+        "Select the correct option and briefly explain why.",
+        "",
+        f"Question: {question}",
+    ]
+    if options:
+        prompt_lines.append("")
+        prompt_lines.extend(options)
+    # Intentionally omit app explanation to keep the prompt short and faster.
+    return "\n".join(prompt_lines).strip()
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text(
         "Send me a screenshot (photo or file) and I will extract the question and options."
@@ -92,21 +129,20 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
     suffix = Path(tg_file.file_path or "").suffix or ".jpg"
     filename = f"{uuid.uuid4().hex}{suffix}"
-    save_path = str(Path(SCREENSHOTS_DIR) / filename)
-    await tg_file.download_to_drive(custom_path=save_path)
-    logger.info("Downloaded image to %s", save_path)
+    # Parse straight from memory; writing to disk is only for keeping a copy
+    img_bytes = bytes(await tg_file.download_as_bytearray())
+    logger.info("Downloaded image %s (%d bytes)", filename, len(img_bytes))
+    if SAVE_SCREENSHOTS:
+        save_path = Path(SCREENSHOTS_DIR) / filename
+        await asyncio.to_thread(save_path.write_bytes, img_bytes)
+        logger.info("Saved image to %s", save_path)
 
     await safe_reply(message, "Processing the screenshot. This can take a moment...")
 
     try:
-        global query_engine
-        if query_engine is None:
-            logger.info("Initializing RAG query engine")
-            query_engine = await asyncio.wait_for(asyncio.to_thread(get_query_engine), timeout=90)
-
         logger.info("Parsing screenshot")
         t_parse_start = time.perf_counter()
-        data = await asyncio.wait_for(asyncio.to_thread(parse_screenshot, save_path), timeout=120)
+        data = await asyncio.wait_for(parse_screenshot_limited(img_bytes, filename), timeout=120)
         t_parse = time.perf_counter() - t_parse_start
         parsed_text = format_result(data)
 
@@ -119,23 +155,22 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         await safe_reply(message, "Screenshot parsed successfully. Running RAG...")
 
         question = data.get("question", "").strip()
-        options = data.get("options", [])
-
-        prompt_lines = [
-            "Analyze the driver's theory test question (Spanish Permiso B / DGT).",
-            "Select the correct option and briefly explain why.",
-            "",
-            f"Question: {question}",
-        ]
-        if options:
-            prompt_lines.append("")
-            prompt_lines.extend(options)
-        # Intentionally omit app explanation to keep the prompt short and faster.
-
-        query = "\n".join(prompt_lines).strip()
-        logger.info("Querying RAG")
+        # The vision model may return null or non-string options; keep the strings
+        options = tuple(opt for opt in data.get("options") or [] if isinstance(opt, str))
+
+        query = build_query(question, options)
         t_rag_start = time.perf_counter()
-        response = await asyncio.wait_for(asyncio.to_thread(query_engine.query, query), timeout=120)
+        response = exact_cache.get(question, options)
+        if response is not None:
+            logger.info("RAG exact cache hit %s", exact_cache.stats())
+        else:
+            logger.info("Querying RAG")
+            # Retrieve (and match near-duplicates) on the question itself, not the instructions
+            search_text = "\n".join([question, *options])
+            response, cached = await asyncio.wait_for(aanswer_query(query, search_text), timeout=120)
+            # Semantic hits answered a near-duplicate question; only persist fresh answers
+            if not cached:
+                exact_cache.put(question, options, response)
         t_rag = time.perf_counter() - t_rag_start
 
         output_text = f"{parsed_text}\n\n---\n\nRAG Answer:\n{response}\n\nTiming: parse={t_parse:.2f}s rag={t_rag:.2f}s"
@@ -169,8 +204,22 @@ async def safe_reply(message, text: str, retries: int = 3) -> None:
     await message.reply_text(text)
 
 
+async def post_init(app) -> None:
+    # Load the index and open the model connections off the event loop
+    warmup_task = asyncio.create_task(asyncio.to_thread(warmup))
+    background_tasks.add(warmup_task)
+    warmup_task.add_done_callback(background_tasks.discard)
+
+
 def main() -> None:
-    app = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
+    # Concurrent updates let screenshots from different chats be parsed in parallel
+    app = (
+        ApplicationBuilder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(True)
+        .post_init(post_init)
+        .build()
+    )
     app.add_handler(CommandHandler("start", start))
     app.add_handler(MessageHandler(filters.PHOTO | filters.Document.IMAGE, handle_image))
     app.add_error_handler(error_handler)
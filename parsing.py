@@ -1,10 +1,13 @@
 import os
+import asyncio
 import base64
 import json
+import re
 import time
 import io
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 from PIL import Image  # optional: to check/resize images
 from dotenv import load_dotenv
 
@@ -14,12 +17,21 @@ load_dotenv()
 # ================== CONFIG ==================
 client = OpenAI(
     api_key=os.getenv("XAI_API_KEY"),        # your xai-... key
-    base_url="https://api.x.ai/v1"
+    base_url="https://api.x.ai/v1",
+    # the SDK retries 429/5xx with exponential backoff (honors Retry-After)
+    max_retries=int(os.getenv("PARSE_MAX_RETRIES", "5")),
+)
+# Used by the bot: awaiting the HTTP call doesn't tie up a worker thread
+async_client = AsyncOpenAI(
+    api_key=os.getenv("XAI_API_KEY"),
+    base_url="https://api.x.ai/v1",
+    max_retries=int(os.getenv("PARSE_MAX_RETRIES", "5")),
 )
 
 MODEL = "grok-4"          # or "grok-2-vision-1212" if you want the dedicated vision model
 SCREENSHOTS_FOLDER = "Dl screenshots"   # put your phone screenshots here
 OUTPUT_FOLDER = "driving_data/parsed"
+PARSE_CONCURRENCY = int(os.getenv("PARSE_CONCURRENCY", "8"))  # parallel API calls in folder mode
 
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
@@ -39,28 +51,83 @@ Analyze the screenshot and return ONLY valid JSON:
 PARSE_MAX_DIM = int(os.getenv("PARSE_MAX_DIM", "1280"))  # max width/height
 PARSE_JPEG_QUALITY = int(os.getenv("PARSE_JPEG_QUALITY", "75"))
 PARSE_DETAIL = os.getenv("PARSE_DETAIL", "low").lower()
+PARSE_PASSTHROUGH_BYTES = int(os.getenv("PARSE_PASSTHROUGH_BYTES", "300000"))  # 0 disables
+PARSE_CROP = os.getenv("PARSE_CROP", "0") == "1"  # crop uniform margins before upload
+PARSE_CROP_MIN_AREA = float(os.getenv("PARSE_CROP_MIN_AREA", "0.2"))  # below this, keep full image
+# ```json ... ``` (or bare ```) fence around the model output; closing fence optional
+_FENCE_RE = re.compile(r"```(?:json)?\s*(.*?)(?:```|$)", re.S)
+
+
+def _bar_extent(profile: list, background: int, limit: int) -> int:
+    # Leading run of lines far from the page background: system bars, window frames
+    n = 0
+    while n < limit and abs(profile[n] - background) > 48:
+        n += 1
+    return n
+
+
+def _detect_content_bbox(img: Image.Image):
+    # Page background is the most common grey level (the corners are unreliable:
+    # phone screenshots carry a dark nav bar / frame there). Status/nav bars are
+    # trimmed by row and column profile, then the box covers everything that
+    # differs from the background. None when the result looks unreliable.
+    gray = img.convert("L")
+    w, h = gray.size
+    hist = gray.histogram()
+    background = max(range(256), key=hist.__getitem__)
+    rows = list(gray.resize((1, h), Image.Resampling.BOX).getdata())
+    cols = list(gray.resize((w, 1), Image.Resampling.BOX).getdata())
+    top = _bar_extent(rows, background, h // 10)
+    bottom = h - _bar_extent(rows[::-1], background, h // 10)
+    left = _bar_extent(cols, background, w // 10)
+    right = w - _bar_extent(cols[::-1], background, w // 10)
+    page = gray.crop((left, top, right, bottom))
+    bbox = page.point(lambda v: 255 if abs(v - background) > 24 else 0).getbbox()
+    if bbox is None:
+        return None
+    x0, y0, x1, y1 = bbox[0] + left, bbox[1] + top, bbox[2] + left, bbox[3] + top
+    if (x1 - x0) * (y1 - y0) < PARSE_CROP_MIN_AREA * w * h:
+        return None
+    pad = 8
+    return (max(x0 - pad, left), max(y0 - pad, top), min(x1 + pad, right), min(y1 + pad, bottom))
 
 
 def encode_image(image_path: str) -> str:
+    return encode_image_bytes(Path(image_path).read_bytes())
+
+
+def encode_image_bytes(img_bytes: bytes) -> str:
     # Resize/compress to reduce upload size and latency
-    with Image.open(image_path) as img:
+    with Image.open(io.BytesIO(img_bytes)) as img:
+        # Small JPEGs are sent as-is: decoding and re-encoding them buys nothing
+        if (
+            img.format == "JPEG"
+            and img.mode in ("RGB", "L")
+            and (PARSE_MAX_DIM <= 0 or max(img.size) <= PARSE_MAX_DIM)
+            and len(img_bytes) <= PARSE_PASSTHROUGH_BYTES
+            and not PARSE_CROP
+        ):
+            return base64.b64encode(img_bytes).decode("ascii")
         img = img.convert("RGB")
+        if PARSE_CROP:
+            # Fewer pixels -> fewer vision tiles billed and processed
+            bbox = _detect_content_bbox(img)
+            if bbox is not None:
+                img = img.crop(bbox)
         if PARSE_MAX_DIM > 0:
-            img.thumbnail((PARSE_MAX_DIM, PARSE_MAX_DIM))
+            # Bilinear is noticeably cheaper than the default bicubic and fine for text
+            img.thumbnail((PARSE_MAX_DIM, PARSE_MAX_DIM), Image.Resampling.BILINEAR)
         buffer = io.BytesIO()
         img.save(buffer, format="JPEG", quality=PARSE_JPEG_QUALITY, optimize=True)
-        return base64.b64encode(buffer.getvalue()).decode("utf-8")
+        return base64.b64encode(buffer.getbuffer()).decode("ascii")
 
 def parse_screenshot(image_path: str):
-    t0 = time.perf_counter()
     print(f"Processing: {image_path}")
-    
-    t_encode_start = time.perf_counter()
-    base64_image = encode_image(image_path)
-    t_encode = time.perf_counter() - t_encode_start
-    
-    t_api_start = time.perf_counter()
-    response = client.chat.completions.create(
+    return parse_screenshot_bytes(Path(image_path).read_bytes(), Path(image_path).name)
+
+
+def _completion_request(base64_image: str) -> dict:
+    return dict(
         model=MODEL,
         messages=[{
             "role": "user",
@@ -78,18 +145,47 @@ def parse_screenshot(image_path: str):
         max_tokens=1200,
         temperature=0.0   # máximo precisión y consistencia
     )
+
+
+def parse_screenshot_bytes(img_bytes: bytes, filename: str):
+    # filename only names the output .json/.txt; the image is never read from disk
+    t0 = time.perf_counter()
+    
+    t_encode_start = time.perf_counter()
+    base64_image = encode_image_bytes(img_bytes)
+    t_encode = time.perf_counter() - t_encode_start
+    
+    t_api_start = time.perf_counter()
+    response = client.chat.completions.create(**_completion_request(base64_image))
     t_api = time.perf_counter() - t_api_start
     
+    return _handle_response(response, filename, t0, t_encode, t_api)
+
+
+async def parse_screenshot_bytes_async(img_bytes: bytes, filename: str):
+    t0 = time.perf_counter()
+    
+    t_encode_start = time.perf_counter()
+    base64_image = await asyncio.to_thread(encode_image_bytes, img_bytes)
+    t_encode = time.perf_counter() - t_encode_start
+    
+    t_api_start = time.perf_counter()
+    response = await async_client.chat.completions.create(**_completion_request(base64_image))
+    t_api = time.perf_counter() - t_api_start
+    
+    return await asyncio.to_thread(_handle_response, response, filename, t0, t_encode, t_api)
+
+
+def _handle_response(response, filename: str, t0: float, t_encode: float, t_api: float):
     raw_text = response.choices[0].message.content.strip()
     
     # Intentar extraer JSON (Grok suele devolverlo limpio)
     t_parse_start = time.perf_counter()
     try:
         # Si viene con ```json ... ``` lo limpiamos
-        if "```json" in raw_text:
-            raw_text = raw_text.split("```json")[1].split("```")[0].strip()
-        elif "```" in raw_text:
-            raw_text = raw_text.split("```")[1].strip()
+        match = _FENCE_RE.search(raw_text)
+        if match:
+            raw_text = match.group(1).strip()
         
         data = json.loads(raw_text)
     except Exception:
@@ -97,13 +193,13 @@ def parse_screenshot(image_path: str):
     t_parse = time.perf_counter() - t_parse_start
     
     t_save_start = time.perf_counter()
+    output_path = Path(OUTPUT_FOLDER) / f"{Path(filename).stem}.json"
+    txt_path = output_path.with_suffix(".txt")
     # Guardar JSON
-    output_path = Path(OUTPUT_FOLDER) / f"{Path(image_path).stem}.json"
     with open(output_path, "w", encoding="utf-8") as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
     
     # Also save a readable .txt for your RAG
-    txt_path = Path(OUTPUT_FOLDER) / f"{Path(image_path).stem}.txt"
     with open(txt_path, "w", encoding="utf-8") as f:
         f.write(f"Question: {data.get('question', '')}\n\n")
         for opt in data.get("options", []):
@@ -130,8 +226,9 @@ if __name__ == "__main__":
     
     print(f"Found {len(all_images)} screenshots to process...\n")
     
-    for img_path in sorted(all_images):
-        parse_screenshot(str(img_path))
+    # API latency dominates, so keep several requests in flight
+    with ThreadPoolExecutor(max_workers=PARSE_CONCURRENCY) as executor:
+        list(executor.map(parse_screenshot, map(str, sorted(all_images))))
     
     print("Done! All files are in driving_data/parsed/")
     print("You can add them to your RAG index by running your LlamaIndex script again.")
@@ -1,32 +1,81 @@
+import asyncio
+import json
+import logging
 import os
+import re
+import threading
+import time
 
+import httpx
+import numpy as np
 from llama_index.core import (
+    QueryBundle,
     Settings,
     SimpleDirectoryReader,
     StorageContext,
     VectorStoreIndex,
     load_index_from_storage,
 )
+from llama_index.core.indices.prompt_helper import PromptHelper
+from llama_index.core.ingestion import IngestionPipeline
+from llama_index.core.llms import ChatMessage, MessageRole
+from llama_index.core.prompts.chat_prompts import CHAT_TEXT_QA_PROMPT, TEXT_QA_SYSTEM_PROMPT
+from llama_index.core.schema import MetadataMode
 from llama_index.embeddings.openai import OpenAIEmbedding
 from llama_index.llms.ollama import Ollama
 from dotenv import load_dotenv
 
+from rag_cache import LRUSimCache, aembed_query, embed_query
+from vector_store import JSON_FILE, MatrixVectorStore, fingerprint
+
 load_dotenv()
 
+logger = logging.getLogger("rag")
+
+# ================== HTTP ==================
+# One keep-alive pool (HTTP/2 where the server offers it) shared by the embedding
+# and LLM clients, so calls reuse connections instead of re-handshaking TLS.
+_HTTP_LIMITS = httpx.Limits(max_keepalive_connections=32, max_connections=64)
+_http_client = httpx.Client(http2=True, limits=_HTTP_LIMITS, timeout=180.0)
+_async_http_client = httpx.AsyncClient(http2=True, limits=_HTTP_LIMITS, timeout=180.0)
+# OpenAIEmbedding/OpenAILike retry 429/5xx/timeouts with jittered exponential
+# backoff (tenacity) up to this many attempts.
+MAX_RETRIES = int(os.getenv("RAG_MAX_RETRIES", "5"))
+
 
 def configure_llm() -> None:
+    Settings.embed_model = build_embed_model()
+    Settings.llm = build_llm()
+
+
+def build_embed_model(shared_http: bool = True) -> OpenAIEmbedding:
     # ================== EMBEDDINGS ==================
+    # shared_http=False for models that get pickled (IngestionPipeline worker
+    # processes): httpx clients hold locks and SSL contexts and can't be pickled.
     openai_api_key = os.getenv("OPENAI_API_KEY")
     if not openai_api_key:
         raise RuntimeError("Missing OPENAI_API_KEY for OpenAI embeddings.")
     embed_model = os.getenv("EMBEDDINGS_MODEL", "text-embedding-3-small")
-    Settings.embed_model = OpenAIEmbedding(
+    return OpenAIEmbedding(
         model=embed_model,
         api_key=openai_api_key,
+        # inputs per /v1/embeddings request (API max 2048; keep under the per-request token cap)
+        embed_batch_size=int(os.getenv("RAG_EMBED_BATCH_SIZE", "256")),
+        http_client=_http_client if shared_http else None,
+        async_http_client=_async_http_client if shared_http else None,
+        max_retries=MAX_RETRIES,
     )
 
+
+def build_llm():
+    # LLM choice (set LLM_PROVIDER=grok or LLM_PROVIDER=ollama); shared with app.py
     llm_provider = os.getenv("LLM_PROVIDER", "ollama").lower()
     if llm_provider == "grok":
+        # Grok API via OpenAI-compatible endpoint
+        # Expected env vars:
+        #   XAI_API_KEY or OPENAI_API_KEY (required)
+        #   GROK_MODEL (optional, default grok-4-0709)
+        #   GROK_CONTEXT_WINDOW (optional, default 128000)
         from llama_index.llms.openai_like import OpenAILike
 
         grok_api_key = os.getenv("XAI_API_KEY") or os.getenv("OPENAI_API_KEY")
@@ -36,7 +85,7 @@ def configure_llm() -> None:
         grok_model = os.getenv("GROK_MODEL", "grok-4-0709")
         grok_context_window = int(os.getenv("GROK_CONTEXT_WINDOW", "128000"))
 
-        Settings.llm = OpenAILike(
+        return OpenAILike(
             model=grok_model,
             api_base="https://api.x.ai/v1",
             api_key=grok_api_key,
@@ -44,26 +93,450 @@ def configure_llm() -> None:
             is_chat_model=True,
             is_function_calling_model=False,
             timeout=180.0,
+            http_client=_http_client,
+            async_http_client=_async_http_client,
+            max_retries=MAX_RETRIES,
+        )
+    # The ollama client builds its own httpx pool (kept per LLM instance)
+    return Ollama(model="llama3.2", request_timeout=180.0)  # Works great in Spanish
+
+
+# ================== INDEX ==================
+# Read once at import; nothing on the query path parses env vars.
+PREBUILT_ONLY = os.getenv("PREBUILT_INDEX", "1") == "1"
+TOP_K = int(os.getenv("RAG_TOP_K", "4"))
+LOAD_WORKERS = int(os.getenv("RAG_LOAD_WORKERS", str(max(1, (os.cpu_count() or 1) - 1))))
+INGEST_WORKERS = int(os.getenv("RAG_INGEST_WORKERS", "0")) or None
+# "matrix" (default): llama-index JSON store plus a contiguous float32 matrix
+# (vecs.npy, memory-mapped), queried as one BLAS inner product over pre-normalized
+# vectors. "simple": plain llama-index JSON store, cosine computed per node.
+# "faiss": binary FAISS index (HNSW / quantized variants).
+VECTOR_STORE = os.getenv("RAG_VECTOR_STORE", "matrix").lower()
+MATRIX_INT8 = os.getenv("RAG_MATRIX_INT8", "0") == "1"  # "matrix" store: int8-quantized vectors
+FAISS_PERSIST_DIR = os.getenv("RAG_FAISS_DIR", "./storage_faiss")
+FAISS_SOURCE_FILE = "source.json"  # fingerprint of the JSON store it was built from
+FAISS_MMAP = os.getenv("RAG_FAISS_MMAP", "1") == "1"  # "ivfpq" only, see _load_faiss_index
+HNSW_M = int(os.getenv("RAG_HNSW_M", "32"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("RAG_HNSW_EF_CONSTRUCTION", "80"))
+HNSW_EF_SEARCH = int(os.getenv("RAG_EF_SEARCH", "64"))  # higher = better recall, slower
+# Compression of the stored vectors: "none" (fp32), "sq8" (int8 scalar, 4x smaller),
+# "pq" (product quantization, RAG_PQ_M bytes per vector; needs >= 256 vectors) or
+# "ivfpq" (PQ codes in RAG_IVF_NLIST inverted lists; only RAG_IVF_NPROBE lists scanned)
+FAISS_QUANT = os.getenv("RAG_FAISS_QUANT", "none").lower()
+PQ_M = int(os.getenv("RAG_PQ_M", "64"))
+IVF_NLIST = int(os.getenv("RAG_IVF_NLIST", "0"))  # 0 = derive from corpus size
+IVF_NPROBE = int(os.getenv("RAG_IVF_NPROBE", "16"))
+
+
+def _embed_documents(data_dir: str):
+    # Split + embed in one pipeline; embeddings go out in batched requests
+    # (RAG_EMBED_BATCH_SIZE inputs each) instead of one call per chunk.
+    # Files are parsed in a process pool; set RAG_LOAD_WORKERS=1 on slow (HDD) disks
+    documents = SimpleDirectoryReader(data_dir).load_data(num_workers=LOAD_WORKERS)
+    # With RAG_INGEST_WORKERS > 1 the transformations are pickled into worker
+    # processes, so the embed model can't carry the shared HTTP pool there
+    embed_model = build_embed_model(shared_http=INGEST_WORKERS is None or INGEST_WORKERS <= 1)
+    pipeline = IngestionPipeline(transformations=[Settings.node_parser, embed_model])
+    return pipeline.run(documents=documents, num_workers=INGEST_WORKERS, show_progress=True)
+
+
+def _new_faiss_index(num_vectors: int, dim: int):
+    import faiss
+
+    # Embeddings are unit-normalized, so inner product == cosine similarity
+    if FAISS_QUANT == "ivfpq":
+        # ~4*sqrt(N) lists, capped so k-means has enough training points per list
+        nlist = IVF_NLIST or max(1, min(1024, int(4 * num_vectors**0.5), num_vectors // 39))
+        return faiss.index_factory(dim, f"IVF{nlist},PQ{PQ_M}x8", faiss.METRIC_INNER_PRODUCT)
+    if FAISS_QUANT == "sq8":
+        faiss_index = faiss.IndexHNSWSQ(
+            dim, faiss.ScalarQuantizer.QT_8bit, HNSW_M, faiss.METRIC_INNER_PRODUCT
         )
+    elif FAISS_QUANT == "pq":
+        return faiss.IndexPQ(dim, PQ_M, 8, faiss.METRIC_INNER_PRODUCT)
     else:
-        Settings.llm = Ollama(model="llama3.2", request_timeout=180.0)
+        faiss_index = faiss.IndexHNSWFlat(dim, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+    faiss_index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    return faiss_index
 
 
-def get_query_engine(persist_dir: str = "./storage", data_dir: str = "driving_data"):
-    configure_llm()
-    prebuilt_only = os.getenv("PREBUILT_INDEX", "1") == "1"
+def _log_faiss_recall(faiss_index, embeddings: np.ndarray) -> None:
+    import faiss
+
+    # Compare the approximate/compressed index against exact search on a sample;
+    # FAISS ids follow insertion order, i.e. the rows of `embeddings`.
+    top_k = min(TOP_K, len(embeddings))
+    sample = embeddings[: min(200, len(embeddings))]
+    exact = faiss.IndexFlatIP(embeddings.shape[1])
+    exact.add(embeddings)
+    _, expected = exact.search(sample, top_k)
+    _, found = faiss_index.search(sample, top_k)
+    recall = np.mean([len(set(e) & set(f)) / top_k for e, f in zip(expected, found)])
+    logger.info("FAISS index (%s) recall@%d vs exact search: %.3f", FAISS_QUANT, top_k, recall)
+
+
+def _tune_faiss_index(faiss_index):
+    if hasattr(faiss_index, "hnsw"):
+        faiss_index.hnsw.efSearch = HNSW_EF_SEARCH
+    if hasattr(faiss_index, "nprobe"):
+        faiss_index.nprobe = IVF_NPROBE
+    return faiss_index
+
+
+def _build_faiss_index(persist_dir: str, data_dir: str):
+    from llama_index.vector_stores.faiss import FaissVectorStore
+
+    if os.path.exists(persist_dir):
+        # Reuse the embeddings of the prebuilt JSON index instead of re-embedding
+        source = load_index_from_storage(StorageContext.from_defaults(persist_dir=persist_dir))
+        nodes = source.docstore.get_nodes(list(source.index_struct.nodes_dict.values()))
+        for node in nodes:
+            node.embedding = source.vector_store.get(node.node_id)
+    elif PREBUILT_ONLY:
+        raise RuntimeError(
+            f"Prebuilt index not found at {persist_dir}. "
+            "Build it locally and include the storage directory in the image."
+        )
+    else:
+        # Embed up front: quantized indexes must be trained before anything is added
+        nodes = _embed_documents(data_dir)
+
+    embeddings = np.asarray([node.embedding for node in nodes], dtype=np.float32)
+    faiss_index = _tune_faiss_index(_new_faiss_index(*embeddings.shape))
+    if not faiss_index.is_trained:
+        faiss_index.train(embeddings)
+    storage_context = StorageContext.from_defaults(vector_store=FaissVectorStore(faiss_index=faiss_index))
+    index = VectorStoreIndex(nodes, storage_context=storage_context)
+    _log_faiss_recall(faiss_index, embeddings)
+    index.storage_context.persist(persist_dir=FAISS_PERSIST_DIR)
+    # Which JSON store the FAISS index was built from, see _faiss_index_is_current
+    with open(os.path.join(FAISS_PERSIST_DIR, FAISS_SOURCE_FILE), "w", encoding="utf-8") as f:
+        json.dump(fingerprint(os.path.join(persist_dir, JSON_FILE)), f)
+    return index
+
+
+def _load_faiss_index():
+    import faiss
+    from llama_index.vector_stores.faiss import FaissVectorStore
+
+    path = os.path.join(FAISS_PERSIST_DIR, "default__vector_store.json")  # binary despite the name
+    faiss_index = None
+    if FAISS_MMAP and FAISS_QUANT == "ivfpq":
+        # IO_FLAG_MMAP only maps IVF inverted lists (the PQ codes): those pages are
+        # shared between bot processes and evictable. Other index types are always
+        # read fully into memory, so they skip this.
+        try:
+            faiss_index = faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError:
+            faiss_index = None  # index type without mmap support
+    if faiss_index is None:
+        faiss_index = faiss.read_index(path)
+    storage_context = StorageContext.from_defaults(
+        vector_store=FaissVectorStore(faiss_index=_tune_faiss_index(faiss_index)),
+        persist_dir=FAISS_PERSIST_DIR,
+    )
+    return load_index_from_storage(storage_context)
+
+
+def _load_matrix_store(persist_dir: str) -> MatrixVectorStore:
+    # Map the vecs.npy sidecar instead of parsing embeddings out of the JSON store;
+    # the first load of a JSON-only index writes the sidecar for the next start.
+    vector_store = MatrixVectorStore.from_matrix_file(persist_dir, int8=MATRIX_INT8)
+    if vector_store is not None:
+        return vector_store
+    vector_store = MatrixVectorStore.from_persist_path(os.path.join(persist_dir, JSON_FILE))
+    vector_store.int8 = MATRIX_INT8
+    try:
+        vector_store.persist_matrix(persist_dir)
+    except OSError:
+        logger.warning("Could not write the vector matrix to %s", persist_dir, exc_info=True)
+    return vector_store
+
+
+def _faiss_index_is_current(persist_dir: str) -> bool:
+    if not os.path.exists(FAISS_PERSIST_DIR):
+        return False
+    source = fingerprint(os.path.join(persist_dir, JSON_FILE))
+    if source is None:
+        return True  # FAISS-only deployment, nothing to compare against
+    try:
+        with open(os.path.join(FAISS_PERSIST_DIR, FAISS_SOURCE_FILE), encoding="utf-8") as f:
+            built_from = json.load(f)
+    except (OSError, ValueError):
+        built_from = None
+    if built_from != source:
+        logger.warning("FAISS index in %s is out of date with %s, rebuilding", FAISS_PERSIST_DIR, persist_dir)
+        return False
+    return True
+
+
+def _load_index(persist_dir: str, data_dir: str):
+    if VECTOR_STORE == "faiss":
+        if _faiss_index_is_current(persist_dir):
+            return _load_faiss_index()
+        return _build_faiss_index(persist_dir, data_dir)
+
     if not os.path.exists(persist_dir):
-        if prebuilt_only:
+        if PREBUILT_ONLY:
             raise RuntimeError(
                 f"Prebuilt index not found at {persist_dir}. "
                 "Build it locally and include the storage directory in the image."
             )
-        documents = SimpleDirectoryReader(data_dir).load_data()
-        index = VectorStoreIndex.from_documents(documents)
+        storage_context = StorageContext.from_defaults(
+            vector_store=MatrixVectorStore(int8=MATRIX_INT8) if VECTOR_STORE == "matrix" else None
+        )
+        index = VectorStoreIndex(_embed_documents(data_dir), storage_context=storage_context)
         index.storage_context.persist(persist_dir=persist_dir)
+        if VECTOR_STORE == "matrix":
+            index.vector_store.persist_matrix(persist_dir)
     else:
-        storage_context = StorageContext.from_defaults(persist_dir=persist_dir)
+        vector_store = None
+        if VECTOR_STORE == "matrix":
+            vector_store = _load_matrix_store(persist_dir)
+        storage_context = StorageContext.from_defaults(persist_dir=persist_dir, vector_store=vector_store)
         index = load_index_from_storage(storage_context)
+    return index
+
+
+def get_query_engine(persist_dir: str = "./storage", data_dir: str = "driving_data"):
+    configure_llm()
+    index = _load_index(persist_dir, data_dir)
+    return index.as_query_engine(similarity_top_k=TOP_K)
+
+
+# ================== ANSWERING ==================
+_query_engine = None
+_query_engine_lock = threading.Lock()
+
+
+def _get_query_engine():
+    # Double-checked: concurrent first queries (and warmup) build the index once
+    global _query_engine
+    if _query_engine is None:
+        with _query_engine_lock:
+            if _query_engine is None:
+                _query_engine = get_query_engine()
+    return _query_engine
+
+
+# Near-duplicate questions (cosine >= RAG_CACHE_THRESHOLD) skip retrieval and the LLM
+_response_cache = LRUSimCache(
+    max_size=int(os.getenv("RAG_CACHE_SIZE", "2000")),
+    ttl=float(os.getenv("RAG_CACHE_TTL", "86400")),
+    threshold=float(os.getenv("RAG_CACHE_THRESHOLD", "0.95")),
+)
+
+
+class _RateLimiter:
+    # Spaces calls at most `rpm` per minute, shared by worker threads and the event
+    # loop, so bursts queue locally instead of drawing 429s from the provider.
+
+    def __init__(self, rpm: int) -> None:
+        self.interval = 60.0 / rpm if rpm > 0 else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        if not self.interval:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+            return slot - now
+
+    def acquire(self) -> None:
+        delay = self._reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def aacquire(self) -> None:
+        delay = self._reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+_llm_limiter = _RateLimiter(int(os.getenv("RAG_RPM", "0")))  # 0 = unlimited
+
+# llama-index's chat text QA template (what the synthesizer sends chat models, i.e.
+# both Grok and Ollama here): the same system message, and the user message
+# pre-split so it is plain string concatenation instead of a template format.
+_QA_PREFIX = "Context information is below.\n---------------------\n"
+_QA_MID = (
+    "\n---------------------\n"
+    "Given the context information and not prior knowledge, answer the query.\n"
+    "Query: "
+)
+_QA_SUFFIX = "\nAnswer: "
+
+
+# A top node this close to the question is sent alone instead of all TOP_K
+SINGLE_NODE_SCORE = float(os.getenv("RAG_SINGLE_NODE_SCORE", "0.8"))
+NODE_MAX_CHARS = int(os.getenv("RAG_NODE_MAX_CHARS", "1024"))  # 0 = no trimming
+
+
+def _trim_context(text: str, options: list) -> str:
+    # Keep a NODE_MAX_CHARS window around the first mention of an asked option,
+    # falling back to the start of the node.
+    if not NODE_MAX_CHARS or len(text) <= NODE_MAX_CHARS:
+        return text
+    lowered = text.lower()
+    hits = [pos for pos in (lowered.find(option.lower()) for option in options) if pos >= 0]
+    start = max(0, min(hits) - NODE_MAX_CHARS // 2) if hits else 0
+    start = min(start, len(text) - NODE_MAX_CHARS)
+    return text[start : start + NODE_MAX_CHARS]
+
+
+def _qa_messages(query: str, nodes, search_text: str) -> list:
+    if nodes and (nodes[0].score or 0.0) >= SINGLE_NODE_SCORE:
+        nodes = nodes[:1]
+    options = [option for _, option in _OPTION_RE.findall(search_text)]
+    chunks = [_trim_context(n.node.get_content(metadata_mode=MetadataMode.LLM), options) for n in nodes]
+    # Same context-window guard the synthesizer applied: shrink chunks that would
+    # not fit next to the template and the model's output budget.
+    chunks = PromptHelper.from_llm_metadata(Settings.llm.metadata).truncate(
+        CHAT_TEXT_QA_PROMPT.partial_format(query_str=query), chunks, llm=Settings.llm
+    )
+    content = _QA_PREFIX + "\n\n".join(chunks) + _QA_MID + query + _QA_SUFFIX
+    return [TEXT_QA_SYSTEM_PROMPT, ChatMessage(role=MessageRole.USER, content=content)]
+
+
+# Provider-side cap on answer length (0 = provider default). Early-closing a
+# llama-index stream leaves the HTTP response open (the connection never returns
+# to the pool and the server keeps decoding), so the cap is enforced by the
+# provider and only trimming to RAG_STOP_AFTER_LINES happens here.
+ANSWER_MAX_TOKENS = int(os.getenv("RAG_ANSWER_MAX_TOKENS", "0"))
+STOP_AFTER_LINES = int(os.getenv("RAG_STOP_AFTER_LINES", "0"))  # 0 = full answer
+
+
+def _limit_tokens(llm, max_tokens: int):
+    # (llm, call kwargs) that stop generation after max_tokens on the provider side
+    if isinstance(llm, Ollama):
+        # Ollama reads generation options from the model, not per call
+        options = {**llm.additional_kwargs, "num_predict": max_tokens}
+        return llm.model_copy(update={"additional_kwargs": options}), {}
+    return llm, {"max_tokens": max_tokens}
+
+
+def _answer_llm():
+    if ANSWER_MAX_TOKENS:
+        return _limit_tokens(Settings.llm, ANSWER_MAX_TOKENS)
+    return Settings.llm, {}
+
+
+def _first_lines(text: str) -> str:
+    if STOP_AFTER_LINES:
+        text = "\n".join([line for line in text.splitlines() if line.strip()][:STOP_AFTER_LINES])
+    return text.strip()
+
+
+def _chat(messages: list) -> str:
+    llm, kwargs = _answer_llm()
+    return _first_lines(llm.chat(messages, **kwargs).message.content or "")
+
+
+async def _achat(messages: list) -> str:
+    llm, kwargs = _answer_llm()
+    return _first_lines((await llm.achat(messages, **kwargs)).message.content or "")
+
+
+# Top node score needed to answer straight from a parsed question-bank entry
+DIRECT_ANSWER_SCORE = float(os.getenv("RAG_DIRECT_SCORE", "0.85"))
+
+_OPTION_RE = re.compile(r"^\s*([A-D])[).]\s*(.+?)\s*$", re.M)
+_CORRECT_RE = re.compile(r"^Correct answer:\s*([A-D])\b", re.M)
+_EXPLANATION_RE = re.compile(r"^Explanation:\s*\n(.+?)(?:\n\s*\n|\Z)", re.M | re.S)
+
+
+def _direct_answer(nodes, search_text: str) -> str | None:
+    # Screenshots parsed into driving_data/parsed (see parsing.py) store the correct
+    # letter. If the best node is that same question, answer without the LLM.
+    if not nodes or (nodes[0].score or 0.0) < DIRECT_ANSWER_SCORE:
+        return None
+    text = nodes[0].node.get_content()
+    correct = _CORRECT_RE.search(text)
+    if correct is None:
+        return None
+    asked = {letter: option for letter, option in _OPTION_RE.findall(search_text)}
+    stored = {letter: option.lower() for letter, option in _OPTION_RE.findall(text)}
+    if not asked or {option.lower() for option in asked.values()} != set(stored.values()):
+        return None
+    correct_option = stored.get(correct.group(1))
+    matches = [letter for letter, option in asked.items() if option.lower() == correct_option]
+    if len(matches) != 1:
+        return None
+
+    lines = [f"Correct answer: {matches[0]}) {asked[matches[0]]}"]
+    explanation = _EXPLANATION_RE.search(text)
+    if explanation:
+        lines.append(f"Explanation: {explanation.group(1).strip()}")
+    return "\n".join(lines)
+
+
+WARMUP = os.getenv("RAG_WARMUP", "1") == "1"
+
+
+def warmup() -> None:
+    # Pay the cold-start costs (index load, HTTP clients, DNS/TLS, Ollama model
+    # load) before the first user query instead of during it.
+    if not WARMUP:
+        return
+    try:
+        _get_query_engine()
+        Settings.embed_model.get_query_embedding("ping")
+        _llm_limiter.acquire()
+        # A one-token generation: enough to open the connection / load the model
+        llm, kwargs = _limit_tokens(Settings.llm, 1)
+        llm.complete("ping", **kwargs)
+        logger.info("RAG warmup done")
+    except Exception:
+        logger.exception("RAG warmup failed")
+
+
+def answer_query(query: str, search_text: str | None = None) -> tuple[str, bool]:
+    # search_text (default: query) is what gets embedded; one embedding serves both
+    # the semantic cache lookup and retrieval. Returns (response, cached): cached
+    # answers may belong to a near-duplicate question, so callers must not store
+    # them under this question's exact key.
+    query_engine = _get_query_engine()
+
+    search_text = search_text or query
+    embedding = embed_query(search_text)
+    cached = _response_cache.get(search_text, embedding=embedding)
+    if cached is not None:
+        logger.info("RAG cache hit %s", _response_cache.stats())
+        return cached, True
+
+    bundle = QueryBundle(query_str=query, custom_embedding_strs=[search_text], embedding=embedding)
+    nodes = query_engine.retrieve(bundle)
+    response = _direct_answer(nodes, search_text)
+    if response is None:
+        _llm_limiter.acquire()
+        response = _chat(_qa_messages(query, nodes, search_text))
+    _response_cache.put(search_text, (), response, embedding=embedding)
+    return response, False
+
+
+async def aanswer_query(query: str, search_text: str | None = None) -> tuple[str, bool]:
+    # Same as answer_query, but the embedding and LLM calls are awaited instead of
+    # holding a worker thread for their whole duration.
+    query_engine = _query_engine
+    if query_engine is None:
+        # The build blocks (and may wait on the lock), keep it off the event loop
+        query_engine = await asyncio.to_thread(_get_query_engine)
+
+    search_text = search_text or query
+    embedding = await aembed_query(search_text)
+    cached = _response_cache.get(search_text, embedding=embedding)
+    if cached is not None:
+        logger.info("RAG cache hit %s", _response_cache.stats())
+        return cached, True
 
-    top_k = int(os.getenv("RAG_TOP_K", "4"))
-    return index.as_query_engine(similarity_top_k=top_k)
+    bundle = QueryBundle(query_str=query, custom_embedding_strs=[search_text], embedding=embedding)
+    nodes = await query_engine.aretrieve(bundle)
+    response = _direct_answer(nodes, search_text)
+    if response is None:
+        await _llm_limiter.aacquire()
+        response = await _achat(_qa_messages(query, nodes, search_text))
+    _response_cache.put(search_text, (), response, embedding=embedding)
+    return response, False
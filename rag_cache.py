@@ -0,0 +1,222 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Iterable, Optional
+
+import numpy as np
+from llama_index.core import Settings
+
+
+def normalize_query(question: str, options: Iterable[str] = ()) -> str:
+    parts = [question.strip().lower()]
+    parts.extend(sorted(opt.strip().lower() for opt in options))
+    return "\n".join(parts)
+
+
+def cache_key(question: str, options: Iterable[str] = ()) -> str:
+    return hashlib.blake2b(normalize_query(question, options).encode("utf-8"), digest_size=16).hexdigest()
+
+
+# Memoized query embeddings: a repeated prompt skips the embedding round trip
+# even when the response cache misses. Shared by the sync and async paths.
+_QUERY_EMBEDDINGS_SIZE = 4096
+_query_embeddings: "OrderedDict[str, list]" = OrderedDict()
+_query_embeddings_lock = threading.Lock()
+
+
+def _cached_query_embedding(text: str) -> Optional[list]:
+    with _query_embeddings_lock:
+        embedding = _query_embeddings.get(text)
+        if embedding is not None:
+            _query_embeddings.move_to_end(text)
+        return embedding
+
+
+def _remember_query_embedding(text: str, embedding: list) -> None:
+    with _query_embeddings_lock:
+        _query_embeddings[text] = embedding
+        _query_embeddings.move_to_end(text)
+        while len(_query_embeddings) > _QUERY_EMBEDDINGS_SIZE:
+            _query_embeddings.popitem(last=False)
+
+
+def embed_query(text: str) -> list:
+    embedding = _cached_query_embedding(text)
+    if embedding is None:
+        embedding = Settings.embed_model.get_query_embedding(text)
+        _remember_query_embedding(text, embedding)
+    return embedding
+
+
+async def aembed_query(text: str) -> list:
+    embedding = _cached_query_embedding(text)
+    if embedding is None:
+        embedding = await Settings.embed_model.aget_query_embedding(text)
+        _remember_query_embedding(text, embedding)
+    return embedding
+
+
+def clear_query_embeddings() -> None:
+    with _query_embeddings_lock:
+        _query_embeddings.clear()
+
+
+class LRUSimCache:
+    # Response cache for RAG answers: exact hits by hash of the normalized
+    # question, fuzzy hits by cosine similarity of the question embedding.
+
+    def __init__(
+        self,
+        max_size: int = 2000,
+        ttl: float = 86400,
+        threshold: float = 0.95,
+        embed_fn: Optional[Callable[[str], list]] = None,
+    ) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.threshold = threshold
+        # Defaults to the memoized Settings.embed_model (see embed_query).
+        self._embed_fn = embed_fn
+        self._lock = threading.RLock()
+        self._entries: "OrderedDict[str, tuple[int, str, str, float]]" = OrderedDict()
+        # Normalized embeddings live in a preallocated matrix, one row per entry,
+        # so a fuzzy lookup is a single mat @ q.
+        self._mat: Optional[np.ndarray] = None
+        self._row_keys: list = [None] * max_size
+        self._free_rows = list(range(max_size - 1, -1, -1))
+        self.hits = 0
+        self.misses = 0
+
+    def _embed(self, text: str, embedding: Optional[list] = None) -> np.ndarray:
+        if embedding is None:
+            embedding = (self._embed_fn or embed_query)(text)
+        vec = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm > 0 else vec
+
+    def _evict(self, key: str) -> None:
+        row, _, _, _ = self._entries.pop(key)
+        self._mat[row] = 0.0
+        self._row_keys[row] = None
+        self._free_rows.append(row)
+
+    def _lookup_similar(self, vec: np.ndarray) -> Optional[str]:
+        if self._mat is None or not self._entries:
+            return None
+        scores = self._mat @ vec
+        row = int(np.argmax(scores))
+        if scores[row] < self.threshold:
+            return None
+        return self._row_keys[row]
+
+    # `embedding` lets callers that already embedded the question (e.g. for
+    # retrieval) skip the embedding call here.
+    def get(self, question: str, options: Iterable[str] = (), embedding: Optional[list] = None) -> Optional[str]:
+        text = normalize_query(question, options)
+        key = cache_key(question, options)
+        with self._lock:
+            if key not in self._entries:
+                key = self._lookup_similar(self._embed(text, embedding))
+            if key is not None:
+                _, _, response, ts = self._entries[key]
+                if time.time() - ts <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return response
+                self._evict(key)
+            self.misses += 1
+            return None
+
+    def put(
+        self, question: str, options: Iterable[str], response: str, embedding: Optional[list] = None
+    ) -> None:
+        text = normalize_query(question, options)
+        key = cache_key(question, options)
+        vec = self._embed(text, embedding)
+        with self._lock:
+            if key in self._entries:
+                self._evict(key)
+            while not self._free_rows:
+                self._evict(next(iter(self._entries)))
+            if self._mat is None:
+                self._mat = np.zeros((self.max_size, vec.shape[0]), dtype=np.float32)
+            row = self._free_rows.pop()
+            self._mat[row] = vec
+            self._row_keys[row] = key
+            self._entries[key] = (row, text, response, time.time())
+
+    def clear(self) -> None:
+        # Called on index rebuild; drop memoized query embeddings along with answers
+        clear_query_embeddings()
+        with self._lock:
+            self._entries.clear()
+            self._mat = None
+            self._row_keys = [None] * self.max_size
+            self._free_rows = list(range(self.max_size - 1, -1, -1))
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+class SQLiteResponseCache:
+    # Persistent exact-match cache: survives restarts and is checked before the
+    # in-memory semantic cache since it needs no embedding call.
+
+    def __init__(self, path: str = "./rag_cache.sqlite3", ttl_days: int = 30) -> None:
+        self.path = path
+        self.ttl = ttl_days * 86400
+        self.hits = 0
+        self.misses = 0
+        # One long-lived autocommit connection in WAL mode: no per-call connect or
+        # schema check, readers don't block the writer, and NORMAL sync avoids an
+        # fsync on every insert.
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._lock = threading.Lock()
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT, ts INTEGER)"
+        )
+        self.sweep()
+
+    def sweep(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM responses WHERE ts < ?", (int(time.time()) - self.ttl,))
+
+    def get(self, question: str, options: Iterable[str] = ()) -> Optional[str]:
+        row = self._conn.execute(
+            "SELECT response FROM responses WHERE key = ? AND ts >= ?",
+            (cache_key(question, options), int(time.time()) - self.ttl),
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0]
+
+    def put(self, question: str, options: Iterable[str], response: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, ts) VALUES (?, ?, ?)",
+                (cache_key(question, options), response, int(time.time())),
+            )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
@@ -0,0 +1,254 @@
+import hashlib
+import json
+import logging
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores import SimpleVectorStore
+from llama_index.core.vector_stores.simple import SimpleVectorStoreData
+from llama_index.core.vector_stores.types import (
+    MetadataFilters,
+    VectorStoreQuery,
+    VectorStoreQueryMode,
+    VectorStoreQueryResult,
+)
+
+logger = logging.getLogger("vector_store")
+
+# Sidecar files next to default__vector_store.json: the normalized float32 matrix
+# (memory-mapped on load) and everything else the JSON store holds.
+JSON_FILE = "default__vector_store.json"
+VECS_FILE = "vecs.npy"
+VECS_META_FILE = "vecs_meta.json"
+
+
+def fingerprint(path: str) -> Optional[dict]:
+    # Size + content hash of the JSON store (hashing is far cheaper than parsing it)
+    if not os.path.exists(path):
+        return None
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return {"size": os.path.getsize(path), "blake2b": digest.hexdigest()}
+
+
+class MatrixVectorStore(SimpleVectorStore):
+    # SimpleVectorStore with the same JSON persistence, but queries run as one
+    # inner product over a matrix of pre-normalized embeddings instead of
+    # rebuilding arrays and computing cosine per call.
+
+    # Keep the vectors as per-dimension int8 codes (4x less memory to scan)
+    # instead of float32; scores typically stay within ~1e-3 of the exact cosine.
+    int8: bool = False
+
+    _ids: List[str] = PrivateAttr(default_factory=list)
+    _rows: Dict[str, int] = PrivateAttr(default_factory=dict)  # id -> matrix row
+    _matrix: Optional[np.ndarray] = PrivateAttr(default=None)
+    # int8 mode: v ~= _offset + _codes * _scale
+    _codes: Optional[np.ndarray] = PrivateAttr(default=None)
+    _scale: Optional[np.ndarray] = PrivateAttr(default=None)
+    _offset: Optional[np.ndarray] = PrivateAttr(default=None)
+    # Loaded from VECS_FILE: vectors live only in this memory-mapped matrix, and
+    # data.embedding_dict stays empty until something needs it (see _materialize).
+    _mapped: Optional[np.ndarray] = PrivateAttr(default=None)
+
+    def __init__(self, *args: Any, int8: bool = False, **kwargs: Any) -> None:
+        # SimpleVectorStore.__init__ drops unknown kwargs, so set the field here
+        super().__init__(*args, **kwargs)
+        self.int8 = int8
+
+    @classmethod
+    def from_matrix_file(cls, persist_dir: str, **kwargs: Any) -> Optional["MatrixVectorStore"]:
+        # None if the sidecar is missing or was written for a different JSON store:
+        # mtimes are meaningless after a git checkout or Docker COPY, so the JSON
+        # file's fingerprint recorded at write time decides.
+        meta_path = os.path.join(persist_dir, VECS_META_FILE)
+        vecs_path = os.path.join(persist_dir, VECS_FILE)
+        if not (os.path.exists(meta_path) and os.path.exists(vecs_path)):
+            return None
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("source") != fingerprint(os.path.join(persist_dir, JSON_FILE)):
+            return None
+        mapped = np.load(vecs_path, mmap_mode="r")
+        if len(mapped) != len(meta["ids"]):
+            return None
+        store = cls(
+            data=SimpleVectorStoreData(
+                text_id_to_ref_doc_id=meta["text_id_to_ref_doc_id"],
+                metadata_dict=meta["metadata_dict"],
+            ),
+            **kwargs,
+        )
+        store._ids = meta["ids"]
+        store._mapped = mapped
+        return store
+
+    def persist_matrix(self, persist_dir: str) -> None:
+        # Call after the JSON store is persisted to persist_dir
+        ids, matrix = self._normalized()
+        vecs_path = os.path.join(persist_dir, VECS_FILE)
+        meta_path = os.path.join(persist_dir, VECS_META_FILE)
+        # Write then rename, matrix first: the meta file is what marks the pair valid
+        with open(vecs_path + ".tmp", "wb") as f:
+            np.save(f, matrix)
+        with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "source": fingerprint(os.path.join(persist_dir, JSON_FILE)),
+                    "ids": ids,
+                    "text_id_to_ref_doc_id": self.data.text_id_to_ref_doc_id,
+                    "metadata_dict": self.data.metadata_dict,
+                },
+                f,
+            )
+        os.replace(vecs_path + ".tmp", vecs_path)
+        os.replace(meta_path + ".tmp", meta_path)
+
+    def _normalized(self) -> Tuple[List[str], np.ndarray]:
+        if self._mapped is not None:
+            return self._ids, self._mapped
+        embedding_dict = self.data.embedding_dict
+        ids = list(embedding_dict)
+        matrix = np.asarray([embedding_dict[i] for i in ids], dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        matrix /= norms
+        return ids, matrix
+
+    def _materialize(self, reason: str) -> None:
+        # Copy the mapped rows into embedding_dict before anything that reads or
+        # mutates it (writes, persist, filtered queries). Rows are unit length,
+        # which leaves cosine scores unchanged. Retrieval never needs this; the
+        # warning makes a regression that drops the mapping visible in the logs.
+        if self._mapped is None:
+            return
+        logger.warning("Copying %d mapped vectors into memory for %s", len(self._ids), reason)
+        ids, matrix = self._normalized()
+        self.data.embedding_dict = dict(zip(ids, matrix.tolist()))
+        self._mapped = None
+        self._reset()
+
+    def _build(self) -> None:
+        self._ids, matrix = self._normalized()
+        self._rows = {node_id: row for row, node_id in enumerate(self._ids)}
+        if not self.int8:
+            self._matrix = matrix
+            return
+        low, high = matrix.min(axis=0), matrix.max(axis=0)
+        scale = (high - low) / 255
+        scale[scale == 0] = 1.0
+        codes = np.rint((matrix - low) / scale) - 128
+        self._codes = np.clip(codes, -128, 127).astype(np.int8)
+        self._scale = scale.astype(np.float32)
+        self._offset = (low + 128 * scale).astype(np.float32)
+        self._matrix = None
+
+    def _reset(self) -> None:
+        self._matrix = self._codes = self._scale = self._offset = None
+
+    def _scores(self, q: np.ndarray) -> np.ndarray:
+        if self._matrix is None and self._codes is None:
+            self._build()
+        if self._codes is None:
+            return self._matrix @ q
+        # q.v = q.offset + codes @ (scale * q); upcast codes in blocks so the
+        # float32 temporary stays cache-sized and the product is still one SGEMV each
+        weights = self._scale * q
+        scores = np.empty(len(self._codes), dtype=np.float32)
+        for start in range(0, len(self._codes), 4096):
+            block = self._codes[start : start + 4096]
+            scores[start : start + len(block)] = block.astype(np.float32) @ weights
+        return scores + float(self._offset @ q)
+
+    def get(self, text_id: str) -> List[float]:
+        self._materialize("get()")
+        return super().get(text_id)
+
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        self._materialize("add()")
+        self._reset()
+        return super().add(nodes, **add_kwargs)
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        self._materialize("delete()")
+        self._reset()
+        super().delete(ref_doc_id, **delete_kwargs)
+
+    def delete_nodes(
+        self,
+        node_ids: Optional[List[str]] = None,
+        filters: Optional[MetadataFilters] = None,
+        **delete_kwargs: Any,
+    ) -> None:
+        self._materialize("delete_nodes()")
+        self._reset()
+        super().delete_nodes(node_ids, filters, **delete_kwargs)
+
+    def clear(self) -> None:
+        self._mapped = None
+        self._ids = []
+        self._rows = {}
+        self._reset()
+        super().clear()
+
+    def persist(self, *args: Any, **kwargs: Any) -> None:
+        self._materialize("persist()")
+        super().persist(*args, **kwargs)
+
+    def _candidate_rows(self, query: VectorStoreQuery) -> Optional[np.ndarray]:
+        # Rows allowed by node_ids/doc_ids, or None when every row is. The index
+        # retriever always passes node_ids = all nodes of the index, which for a
+        # store holding a single index is exactly the stored ids.
+        rows = None
+        if query.node_ids:
+            rows = {self._rows[i] for i in query.node_ids if i in self._rows}
+        if query.doc_ids:
+            doc_ids = set(query.doc_ids)
+            ref_doc_ids = self.data.text_id_to_ref_doc_id
+            doc_rows = {r for r, i in enumerate(self._ids) if ref_doc_ids.get(i) in doc_ids}
+            rows = doc_rows if rows is None else rows & doc_rows
+        if rows is None or len(rows) == len(self._ids):
+            return None
+        return np.fromiter(sorted(rows), dtype=np.int64, count=len(rows))
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        if (
+            query.mode != VectorStoreQueryMode.DEFAULT
+            or query.filters is not None
+            or query.query_embedding is None
+        ):
+            self._materialize("a filtered or non-default query")
+            return super().query(query, **kwargs)
+        if (self._mapped is None and not self.data.embedding_dict) or (
+            self._mapped is not None and not len(self._mapped)
+        ):
+            return VectorStoreQueryResult(similarities=[], ids=[])
+
+        q = np.asarray(query.query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(q)
+        if norm > 0:
+            q = q / norm
+        # Rows and query are unit length, so the dot product is the cosine similarity
+        scores = self._scores(q)
+        rows = self._candidate_rows(query)
+        if rows is not None:
+            scores = scores[rows]
+        top_k = min(query.similarity_top_k, len(scores))
+        # Partial selection of the top_k (O(N)), then sort only those
+        if top_k < len(scores):
+            idx = np.argpartition(-scores, top_k - 1)[:top_k]
+        else:
+            idx = np.arange(len(scores))
+        idx = idx[np.argsort(-scores[idx])]
+        similarities = scores[idx].tolist()
+        if rows is not None:
+            idx = rows[idx]
+        return VectorStoreQueryResult(
+            similarities=similarities,
+            ids=[self._ids[i] for i in idx],
+        )